@@ -9,7 +9,11 @@ def extract_table(query_name):
     cursor = db_handler.get_cursor()
     root = r"C:\Users\a.tsereteli\Silknet_Cases\Case_11"
     test_query = DBQuery(file_name=query_name, cursor=cursor, by_steps=False, base_folder="queries", root_folder=root)
-    return test_query.run()
+    try:
+        return test_query.run()
+    finally:
+        # give the session back to the pool for the next extraction
+        db_handler.disconnect()
 
 
 
@@ -1,13 +1,22 @@
+import copy
 import json
 import os
+import threading
 from pathlib import Path
 
 import cx_Oracle
 
+DEFAULT_ARRAYSIZE = 10_000
+DEFAULT_STMTCACHESIZE = 100
+DEFAULT_POOL_WAIT_TIMEOUT = 60_000  # milliseconds
+
 
 class DBConnection:
     """Handler class to easily connect to the DB"""
 
+    _pools = {}
+    _pools_lock = threading.Lock()
+
     def __init__(self, config_file: str = "../db.conf", root_folder: str = None):
         """Load the configuration parameters from the given file.
 
@@ -28,12 +37,14 @@ class DBConnection:
             with open(config_file ,"r") as f:
                 self.config=json.load(f)
                 self.connection = None
+        self.pool = None
 
-    def connect(self) -> cx_Oracle.Connection:
-        """Connect to the DB, using the parameters specified in the config file.
+    def __get_pool(self) -> cx_Oracle.SessionPool:
+        """Get the session pool for the configured DB and user, creating it on first use.
+            Pools are shared by all the handlers, so sessions are reused across queries.
 
         Returns:
-            cx_Oracle.Connection: Instance of the DB connection.
+            cx_Oracle.SessionPool: Session pool to acquire connections from.
         """
         dsn = f"""(DESCRIPTION =
             (ADDRESS = (PROTOCOL = TCP)(HOST = {self.config["host"]})(PORT = {self.config["port"]}))
@@ -41,28 +52,90 @@ class DBConnection:
             (SERVER = DEDICATED)
             (SERVICE_NAME = {self.config["service"]})))
         """
+        key = (self.config["user"], dsn)
+
+        with DBConnection._pools_lock:
+            if key not in DBConnection._pools:
+                cursor_sharing = self.config.get("cursor_sharing")
+
+                def init_session(connection, requested_tag):
+                    # run once per new pooled session
+                    if cursor_sharing is not None:
+                        connection.cursor().execute(
+                            f"ALTER SESSION SET cursor_sharing = {cursor_sharing}"
+                        )
+
+                DBConnection._pools[key] = cx_Oracle.SessionPool(
+                    user=self.config["user"],
+                    password=self.config["pass"],
+                    dsn=dsn,
+                    min=int(self.config.get("pool_min", 1)),
+                    max=int(self.config.get("pool_max", 4)),
+                    increment=1,
+                    threaded=True,
+                    # fail instead of hanging forever when all the sessions are held
+                    getmode=cx_Oracle.SPOOL_ATTRVAL_TIMEDWAIT,
+                    waitTimeout=int(self.config.get("pool_wait_timeout", DEFAULT_POOL_WAIT_TIMEOUT)),
+                    encoding="UTF-8",
+                    sessionCallback=init_session,
+                )
+
+            return DBConnection._pools[key]
+
+    def max_sessions(self) -> int:
+        """Get the max number of sessions that the shared pool can hold open at the same time.
+
+        Returns:
+            int: Max size of the session pool.
+        """
+        return self.__get_pool().max
 
-        self.connection = cx_Oracle.connect(
-            user=self.config["user"],
-            password=self.config["pass"],
-            dsn=dsn,
-            encoding="UTF-8",
+    def connect(self) -> cx_Oracle.Connection:
+        """Connect to the DB, using the parameters specified in the config file.
+
+        Returns:
+            cx_Oracle.Connection: Instance of the DB connection.
+        """
+        self.pool = self.__get_pool()
+        self.connection = self.pool.acquire()
+        # keep parsed statements around, so re-running a query skips the parse
+        self.connection.stmtcachesize = int(
+            self.config.get("stmtcachesize", DEFAULT_STMTCACHESIZE)
         )
 
         return self.connection
 
+    def clone(self) -> "DBConnection":
+        """Create a new, not yet connected, handler with the same configuration.
+
+        Returns:
+            DBConnection: Handler class to open an independent connection.
+        """
+        handler = copy.copy(self)
+        handler.connection = None
+        handler.pool = None
+        return handler
+
     def disconnect(self):
-        """Disconnect from the DB"""
-        self.connection.close()
+        """Disconnect from the DB, releasing the connection back to the session pool"""
+        self.pool.release(self.connection)
         self.connection = None
 
     def get_cursor(self) -> cx_Oracle.Cursor:
         """Get the cursor of the connection if active, otherwise connect first.
+            The fetch batch size is taken from the optional "arraysize" and "prefetchrows"
+            config keys, to reduce the number of round-trips on large results.
 
         Returns:
             cx_Oracle.Cursor: DB connection cursor needed to run queries.
         """
-        if self.connection is not None:
-            return self.connection.cursor()
+        if self.connection is None:
+            self.connect()
+
+        cursor = self.connection.cursor()
+        cursor.arraysize = int(self.config.get("arraysize", DEFAULT_ARRAYSIZE))
+        cursor.prefetchrows = int(
+            self.config.get("prefetchrows", cursor.arraysize + 1)
+        )
 
-        return self.connect().cursor()
+        return cursor
@@ -1,47 +1,147 @@
+import hashlib
 import os
+import re
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
+import numpy as np
 import pandas as pd
-from cx_Oracle import Cursor
+from cx_Oracle import Cursor, DatabaseError
 
 pd.set_option("display.max_columns", None)
 pd.set_option("display.width", 1000)
 
+# Known element-wise transformations and their vectorized pandas equivalent
+VECTORIZED_TRANSFORMS = {
+    str.lower: lambda s: s.str.lower(),
+    str.upper: lambda s: s.str.upper(),
+    str.strip: lambda s: s.str.strip(),
+    int: lambda s: s.astype("int64"),
+    float: lambda s: s.astype("float64"),
+    str: lambda s: s.astype(str),
+    pd.Timestamp: pd.to_datetime,
+    pd.to_datetime: pd.to_datetime,
+}
+
+# Line comments and whitespace runs, ignored when comparing cached queries,
+# string literals and quoted identifiers are matched first to keep them untouched
+SQL_NOISE_PATTERN = re.compile(r"""('(?:[^']|'')*'|"[^"]*")|(?:--[^\n]*|\s)+""")
+
+# Name of the parquet files written by DBQueryCache, the hex digest of the cache key
+CACHE_FILE_PATTERN = re.compile(r"[0-9a-f]{32}\.parquet")
+
 
 class DBQueryCache:
     """Cache class to save the result of the queries run."""
 
-    def __init__(self, initialCache: dict = {}):
+    def __init__(self, initialCache: dict = None, cache_dir: str = None, max_size: int = 32):
         """Initializer
 
         Args:
-            initialCache (dict, optional): Initial queries and result cache to inject. Defaults to {}.
+            initialCache (dict, optional): Initial queries and result cache to inject. Defaults to None.
+            cache_dir (str, optional): Folder where results are persisted as parquet files,
+                so they survive restarts. Defaults to None (in-memory only).
+            max_size (int, optional): Max number of results kept in memory, the least recently
+                used are evicted first (they remain on disk if cache_dir is set). Defaults to 32.
+        """
+        self.max_size = max_size
+        # queries steps may run concurrently, guard the in-memory cache
+        self.lock = threading.Lock()
+        self.cache = OrderedDict()
+        for query, result in (initialCache or {}).items():
+            self.__remember(self.key(query), result)
+        self.cache_dir = None
+        if cache_dir is not None:
+            self.cache_dir = Path(cache_dir)
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+
+    @staticmethod
+    def key(query, variant: str = ""):
+        """Get the cache key of a query, equal for queries differing only in comments or whitespace.
+
+        Args:
+            query (str): Query script run.
+            variant (str, optional): Any other setting changing the result data. Defaults to "".
+
+        Returns:
+            bytes: 16 bytes digest of the normalized query.
+        """
+        normalized = SQL_NOISE_PATTERN.sub(lambda m: m.group(1) or " ", query).strip()
+        if variant:
+            normalized += "\0" + variant
+        return hashlib.blake2b(normalized.encode("utf-8"), digest_size=16).digest()
+
+    def __remember(self, key, result):
+        """Keep a result in memory, evicting the least recently used one when full.
+
+        Args:
+            key (bytes): Cache key of the query.
+            result (_type_): Result data obtained.
         """
-        self.cache = initialCache
+        with self.lock:
+            self.cache[key] = result
+            self.cache.move_to_end(key)
+            while len(self.cache) > self.max_size:
+                self.cache.popitem(last=False)
 
-    def put(self, query, result):
+    def put(self, query, result, variant: str = ""):
         """Write a query result in the cache.
 
         Args:
             query (_type_): Query script run.
             result (_type_): Result data obtained.
+            variant (str, optional): Any other setting changing the result data. Defaults to "".
         """
-        self.cache[query] = result
-
-    def get(self, query):
+        key = self.key(query, variant)
+        self.__remember(key, result)
+
+        if self.cache_dir is not None:
+            # write aside and move in place, so concurrent readers never see a partial file
+            path = self.cache_dir / f"{key.hex()}.parquet"
+            tmp_path = self.cache_dir / f"{key.hex()}.{threading.get_ident()}.tmp"
+            try:
+                result.to_parquet(tmp_path, compression="zstd")
+                os.replace(tmp_path, path)
+            except ValueError:
+                # e.g. duplicated column names, keep the result in memory only
+                tmp_path.unlink(missing_ok=True)
+
+    def get(self, query, variant: str = ""):
         """Read query result from cache.
 
         Args:
             query (_type_): Query script run.
+            variant (str, optional): Any other setting changing the result data. Defaults to "".
 
         Returns:
             _type_: Result data cached.
         """
-        return self.cache.get(query)
+        key = self.key(query, variant)
+        with self.lock:
+            result = self.cache.get(key)
+            if result is not None:
+                self.cache.move_to_end(key)
+
+        if result is None and self.cache_dir is not None:
+            path = self.cache_dir / f"{key.hex()}.parquet"
+            if path.exists():
+                result = pd.read_parquet(path)
+                self.__remember(key, result)
+
+        return result
 
     def clear(self):
         """Clear the content present in the cache."""
-        self.cache = {}
+        with self.lock:
+            self.cache = OrderedDict()
+
+        if self.cache_dir is not None:
+            # only the files written by the cache, the folder may hold other data
+            for path in self.cache_dir.glob("*.parquet"):
+                if CACHE_FILE_PATTERN.fullmatch(path.name):
+                    path.unlink()
 
 
 class DBQuery:
@@ -59,6 +159,10 @@ class DBQuery:
         use_cache: bool = True,
         old_cache=None,
         transform: list = None,
+        cache_dir: str = None,
+        dtype: dict = None,
+        db_handler=None,
+        compact: bool = False,
     ):
         """Initializer.
             Load and preprocesse the query from a file or a given string,
@@ -76,6 +180,13 @@ class DBQuery:
             use_cache (bool, optional): If cache should be used to optimize queries. Defaults to True.
             old_cache (DBQueryCache|dict, optional): Initial cache instance. Defaults to None.
             transform (list, optional): List of data transformation to apply to the result. Defaults to None.
+            cache_dir (str, optional): Folder to persist the cached results on disk. Defaults to None.
+            dtype (dict, optional): Numpy dtype of some result columns, by column name,
+                to store them unboxed while fetching. Defaults to None.
+            db_handler (DBConnection, optional): Connection handler used to open extra
+                connections when running steps concurrently. Defaults to None.
+            compact (bool, optional): If result columns should be downcast to the smallest numeric dtype,
+                and low cardinality text columns converted to category. Defaults to False.
         """
         assert not (
             file_name is None and query is None
@@ -100,27 +211,37 @@ class DBQuery:
 
         self.by_steps = by_steps
         self.qry = None
+        self.file_mtime = None
         self.__populate_query()
 
         self.cursor = cursor
-        self.limit = limit
+        self.max_rows = limit
         self.transform = transform
+        self.dtype = dtype
+        self.db_handler = db_handler
+        self.compact = compact
 
         self.cache = None
         if use_cache and old_cache is not None and type(old_cache) is DBQueryCache:
             self.cache = old_cache
         elif use_cache and old_cache is not None and type(old_cache) is dict:
-            self.cache = DBQueryCache(initialCache=old_cache)
+            self.cache = DBQueryCache(initialCache=old_cache, cache_dir=cache_dir)
         elif use_cache and old_cache is None:
-            self.cache = DBQueryCache()
+            self.cache = DBQueryCache(cache_dir=cache_dir)
 
     def __populate_query(self):
-        """Preprocess given file or query content to obtain a list of executable queries."""
+        """Preprocess given file or query content to obtain a list of executable queries.
+            The file is only reloaded if it has been modified since the last load.
+        """
         if self.by_file:
-            with open(self.file_path, "r") as f:
-                lines = f.readlines()
+            file_mtime = self.file_path.stat().st_mtime_ns
+            if self.qry is not None and file_mtime == self.file_mtime:
+                return
+
+            lines = self.file_path.read_text(encoding="utf-8").splitlines(keepends=True)
+            self.file_mtime = file_mtime
         else:
-            lines = self.raw_qry.split("\n")
+            lines = self.raw_qry.splitlines(keepends=True)
 
         if self.by_steps:
             self.qry = self.__process_subqueries(lines)
@@ -176,70 +297,394 @@ class DBQuery:
         """
         for t in self.transform:
             col_name, func = t[0], t[1]
-            result[col_name] = result[col_name].apply(func)
+            vectorized = VECTORIZED_TRANSFORMS.get(func)
+            if vectorized is not None:
+                result[col_name] = vectorized(result[col_name])
+            else:
+                # missing values are passed to func too, as with Series.apply
+                result[col_name] = result[col_name].map(func)
 
         return result
 
+    def __compact(self, result: pd.DataFrame):
+        """Downcast the result columns to smaller dtypes to save memory.
+
+        Args:
+            result (pd.DataFrame): Result dataframe obtained from the query.
+
+        Returns:
+            pd.DataFrame: Modified result dataframe.
+        """
+        # by position, as Oracle may return duplicated column names
+        for i, dtype in enumerate(result.dtypes):
+            col = result.iloc[:, i]
+            if dtype.kind == "i":
+                result.isetitem(i, pd.to_numeric(col, downcast="integer"))
+            elif dtype.kind == "u":
+                result.isetitem(i, pd.to_numeric(col, downcast="unsigned"))
+            elif dtype.kind == "f" and dtype.itemsize > 4:
+                # only downcast to float32 when every value round-trips exactly
+                values = col.to_numpy()
+                with np.errstate(over="ignore"):
+                    downcast = values.astype(np.float32)
+                if np.array_equal(downcast.astype(values.dtype), values, equal_nan=True):
+                    result.isetitem(i, pd.Series(downcast, index=col.index, name=col.name))
+            elif pd.api.types.is_string_dtype(dtype) and col.nunique(dropna=False) < len(col) // 2:
+                result.isetitem(i, col.astype("category"))
+
+        return result
+
+    def __cache_variant(self):
+        """Describe the settings changing the fetched data, to tell apart its cache entries.
+            Includes the DB user and DSN, as a cache_dir may be shared across databases.
+
+        Returns:
+            str: Description of the connection and fetch settings.
+        """
+        connection = self.cursor.connection
+        variant = f"{connection.username}@{connection.dsn}"
+        if self.dtype:
+            dtypes = sorted((col, str(np.dtype(dtype))) for col, dtype in self.dtype.items())
+            variant += repr(dtypes)
+        return variant
+
+    def __fetch_columns(self, cursor: Cursor, num_rows: int = None):
+        """Fetch the executed query result in batches, directly into per-column buffers.
+
+        Args:
+            cursor (Cursor): Cursor where the query has been executed.
+            num_rows (int, optional): Max number of records. Defaults to None.
+
+        Returns:
+            tuple(list, list): Column names and the list or array of values of each column.
+        """
+        cols = [a[0] for a in cursor.description]
+        dtypes = [self.dtype.get(c) if self.dtype is not None else None for c in cols]
+        buffers = [[] for _ in cols]
+
+        remaining = num_rows
+        while remaining is None or remaining > 0:
+            batch_size = cursor.arraysize
+            if remaining is not None:
+                batch_size = min(batch_size, remaining)
+                remaining -= batch_size
+
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+
+            for buffer, dtype, values in zip(buffers, dtypes, zip(*rows)):
+                if dtype is None:
+                    buffer.extend(values)
+                else:
+                    # typed columns are unboxed batch by batch
+                    buffer.append(np.asarray(values, dtype=dtype))
+
+        for i, dtype in enumerate(dtypes):
+            if dtype is not None:
+                buffers[i] = (
+                    np.concatenate(buffers[i]) if buffers[i] else np.empty(0, dtype=dtype)
+                )
+
+        return cols, buffers
+
+    def __fetch_dataframe(self, cursor: Cursor, num_rows: int = None):
+        """Fetch the executed query result as a dataframe.
+
+        Args:
+            cursor (Cursor): Cursor where the query has been executed.
+            num_rows (int, optional): Max number of records. Defaults to None.
+
+        Returns:
+            pd.DataFrame: Result dataframe.
+        """
+        cols, buffers = self.__fetch_columns(cursor, num_rows)
+
+        # Key buffers by position, as Oracle may return duplicated column names
+        res = pd.DataFrame(dict(enumerate(buffers)), columns=range(len(cols)))
+        res.columns = cols
+        return res
+
+    def __limit_query(self, query: str):
+        """Wrap the query step to retrieve only the first records, given by the :lim bind variable.
+            Oracle rejects the wrapper (ORA-00918) if the step selects duplicated column names.
+
+        Args:
+            query (str): Query step string.
+
+        Returns:
+            str: Query step string with the row limit.
+        """
+        query = query.strip().rstrip(";")
+        return f"SELECT * FROM (\n{query}\n) WHERE ROWNUM <= :lim"
+
+    def __execute(self, cursor: Cursor, query: str, num_rows: int = None):
+        """Execute the query step in the DB, limiting the records if needed.
+
+        Args:
+            cursor (Cursor): Cursor to run the query step with.
+            query (str): Query step string to execute.
+            num_rows (int, optional): Max number of records. Defaults to None.
+        """
+        if num_rows is not None:
+            try:
+                # bind the limit, so the statement text is the same for any limit
+                cursor.execute(self.__limit_query(query), {"lim": num_rows})
+                return
+            except DatabaseError as e:
+                # column ambiguously defined, duplicated names can't be wrapped
+                if getattr(e.args[0], "code", None) != 918:
+                    raise
+
+        # without the wrapper, the limit is still applied while fetching
+        cursor.execute(query)
+
     def __run_query_step(
         self,
         query: str,
         num_rows: int = None,
         use_cache: bool = True,
         apply_transform: bool = True,
+        cursor: Cursor = None,
     ):
         """Execute the query step in the DB and return result as a dataframe.
 
         Args:
             query (str): Query step string to execute.
             num_rows (int, optional): Max number of records. Defaults to None.
-            use_cache (bool, optional): Whether to use cache to store the result. Defaults to True.
+            use_cache (bool, optional): Whether to use cache to store the result,
+                ignored when num_rows is given. Defaults to True.
             apply_transform (bool, optional): Whether to apply the transformation steps to the result. Defaults to True.
+            cursor (Cursor, optional): Cursor to run the query step with. Defaults to the query cursor.
 
         Returns:
             pd.DataFrame: Result dataframe.
         """
-        if use_cache and self.cache is not None and self.cache.get(query) is not None:
-            res = self.cache.get(query)
-            print("Using cached result...")
-        else:
-            self.cursor.execute(query)
+        if cursor is None:
+            cursor = self.cursor
 
-            cols = [a[0] for a in self.cursor.description]
+        # limited results are partial, never read or write them in the cache
+        use_cache = use_cache and num_rows is None and self.cache is not None
 
-            if num_rows is None:
-                data = self.cursor.fetchall()
-            else:
-                data = self.cursor.fetchmany(num_rows)
+        # the cache holds the fetched data, before transformation and compaction
+        res = None
+        if use_cache:
+            res = self.cache.get(query, self.__cache_variant())
+            if res is not None:
+                print("Using cached result...")
 
-            res = pd.DataFrame(data, columns=cols)
+        if res is None:
+            self.__execute(cursor, query, num_rows)
+            res = self.__fetch_dataframe(cursor, num_rows)
 
-            if apply_transform and self.transform is not None:
+            if use_cache:
+                self.cache.put(query, res, self.__cache_variant())
+
+        apply_transform = apply_transform and self.transform is not None
+        if apply_transform or self.compact:
+            if use_cache:
+                # keep the cached data untouched
+                res = res.copy()
+
+            if apply_transform:
                 res = self.__apply_transform(res)
 
-            if use_cache and self.cache is not None:
-                self.cache.put(query, res)
+            if self.compact:
+                res = self.__compact(res)
 
         return res
 
-    def run(self, use_cache: bool = True, apply_transform: bool = True):
-        """Double check if the query has changed, reload it and run all the query steps.
+    def limit(self, n: int):
+        """Set the max amount of records to retrieve for each query step.
+            Limited results are not cached, so they never replace or shadow the full ones.
+
+        Args:
+            n (int): Max amount of records, None to retrieve all of them.
+
+        Returns:
+            DBQuery: The same query instance, to allow chaining.
+        """
+        self.max_rows = n
+        return self
+
+    def iterate(self, use_cache: bool = True, apply_transform: bool = True):
+        """Reload the query and lazily run the query steps, one at each iteration.
 
         Args:
             use_cache (bool, optional): Whether to use cache to store the result. Defaults to True.
             apply_transform (bool, optional): Whether to apply the transformation steps to the result. Defaults to True.
 
-        Returns:
-            list: Result list of result dataframes for each step.
+        Yields:
+            pd.DataFrame: Result dataframe of the next query step.
         """
         self.__populate_query()
 
-        return [
-            self.__run_query_step(
-                s,
-                num_rows=self.limit,
+        for q in self.qry:
+            for s in q:
+                yield self.__run_query_step(
+                    s,
+                    num_rows=self.max_rows,
+                    use_cache=use_cache,
+                    apply_transform=apply_transform,
+                )
+
+    def __iter__(self):
+        return self.iterate()
+
+    def __run_query_steps_parallel(
+        self,
+        steps: list,
+        max_workers: int,
+        use_cache: bool = True,
+        apply_transform: bool = True,
+    ):
+        """Execute independent query steps concurrently, each worker thread with its own connection.
+
+        Args:
+            steps (list): Query step strings to execute.
+            max_workers (int): Max number of concurrent connections.
+            use_cache (bool, optional): Whether to use cache to store the result. Defaults to True.
+            apply_transform (bool, optional): Whether to apply the transformation steps to the result. Defaults to True.
+
+        Returns:
+            list: Result list of result dataframes for each step, in the same order.
+        """
+        handlers = []
+        worker = threading.local()
+
+        def run_step(step):
+            # cursors are not thread safe, open one connection per worker thread
+            if not hasattr(worker, "cursor"):
+                handler = self.db_handler.clone()
+                handlers.append(handler)
+                worker.cursor = handler.get_cursor()
+
+            return self.__run_query_step(
+                step,
+                num_rows=self.max_rows,
                 use_cache=use_cache,
                 apply_transform=apply_transform,
+                cursor=worker.cursor,
             )
-            for q in self.qry
-            for s in q
-        ]
+
+        try:
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                results = list(executor.map(run_step, steps))
+        finally:
+            # release every acquired session, even if another release fails,
+            # without hiding the error raised by the query steps
+            release_errors = []
+            for handler in handlers:
+                if handler.connection is None:
+                    continue
+                try:
+                    handler.disconnect()
+                except Exception as e:
+                    release_errors.append(e)
+
+        if release_errors:
+            raise release_errors[0]
+        return results
+
+    def collect(
+        self,
+        use_cache: bool = True,
+        apply_transform: bool = True,
+        max_workers: int = None,
+    ):
+        """Double check if the query has changed, reload it and run all the query steps.
+
+        Args:
+            use_cache (bool, optional): Whether to use cache to store the result. Defaults to True.
+            apply_transform (bool, optional): Whether to apply the transformation steps to the result. Defaults to True.
+            max_workers (int, optional): Run the steps concurrently with up to this number of connections,
+                only for steps that do not depend on each other. Requires db_handler, and is capped
+                to the free sessions of its pool (pool_max - 1). Defaults to None.
+
+        Returns:
+            list: Result list of result dataframes for each step.
+        """
+        if max_workers is None or max_workers <= 1:
+            return list(self.iterate(use_cache=use_cache, apply_transform=apply_transform))
+
+        assert self.db_handler is not None, "db_handler must be provided to run steps concurrently."
+
+        # the workers share the session pool of db_handler, where the query cursor holds one session
+        max_workers = min(max_workers, self.db_handler.max_sessions() - 1)
+        if max_workers <= 1:
+            return list(self.iterate(use_cache=use_cache, apply_transform=apply_transform))
+
+        self.__populate_query()
+        return self.__run_query_steps_parallel(
+            [s for q in self.qry for s in q],
+            max_workers,
+            use_cache=use_cache,
+            apply_transform=apply_transform,
+        )
+
+    def run(
+        self,
+        use_cache: bool = True,
+        apply_transform: bool = True,
+        max_workers: int = None,
+    ):
+        """Alias of collect, run all the query steps.
+
+        Args:
+            use_cache (bool, optional): Whether to use cache to store the result. Defaults to True.
+            apply_transform (bool, optional): Whether to apply the transformation steps to the result. Defaults to True.
+            max_workers (int, optional): Max number of concurrent connections. Defaults to None.
+
+        Returns:
+            list: Result list of result dataframes for each step.
+        """
+        return self.collect(
+            use_cache=use_cache,
+            apply_transform=apply_transform,
+            max_workers=max_workers,
+        )
+
+    def head(self, n: int = 5, apply_transform: bool = True):
+        """Peek the first records of the last query step, without running the previous ones.
+            The row limit is pushed down to the DB, so the full result is never retrieved
+            (unless the step selects duplicated column names, then it is applied while fetching).
+
+        Args:
+            n (int, optional): Number of records to retrieve. Defaults to 5.
+            apply_transform (bool, optional): Whether to apply the transformation steps to the result. Defaults to True.
+
+        Returns:
+            pd.DataFrame: Result dataframe with at most n records.
+        """
+        self.__populate_query()
+
+        assert len(self.qry) > 0 and len(self.qry[-1]) > 0, (
+            "The query has no steps to peek, add SUB_QUERY markers or use by_steps=False."
+        )
+
+        return self.__run_query_step(
+            self.qry[-1][-1],
+            num_rows=n,
+            use_cache=False,
+            apply_transform=apply_transform,
+        )
+
+    def run_arrow(self):
+        """Run all the query steps and return the results as Arrow tables, without building dataframes.
+            Meant for results consumed by pyarrow, parquet or duckdb. Cache and transformations are not applied.
+
+        Returns:
+            list: Result list of pyarrow.Table for each step.
+        """
+        import pyarrow as pa
+
+        self.__populate_query()
+
+        results = []
+        for q in self.qry:
+            for s in q:
+                self.__execute(self.cursor, s, self.max_rows)
+                cols, buffers = self.__fetch_columns(self.cursor, self.max_rows)
+                results.append(pa.Table.from_arrays([pa.array(b) for b in buffers], names=cols))
+
+        return results
@@ -1,7 +1,39 @@
+import functools
+import math
+
 import numpy as np
 import scipy
 
 
+@functools.lru_cache(maxsize=64)
+def _norm_isf(significance):
+    """Cached inverse survival function of the standard normal distribution.
+
+    Args:
+        significance (float): a value from 0 to 1 representing the threshold of
+            statistical significance.
+
+    Returns:
+        float: z score of the null hypothesis at the given significance
+    """
+    return float(scipy.stats.norm.isf(significance, loc=0, scale=1))
+
+
+def _norm_sf(z_score):
+    """Survival function of the standard normal distribution.
+        Scalars are computed with math.erfc, avoiding the scipy distribution overhead.
+
+    Args:
+        z_score (float | np.ndarray): z score(s) to evaluate
+
+    Returns:
+        float | np.ndarray: probability of a value greater than z_score
+    """
+    if np.ndim(z_score) == 0:
+        return 0.5 * math.erfc(float(z_score) / math.sqrt(2))
+    return scipy.stats.norm.sf(z_score)
+
+
 def get_p_value(mean, sd, two_sided=False):
     """Calculate the p value (I.e. the probability of a false positive error.)
 
@@ -19,7 +51,7 @@ def get_p_value(mean, sd, two_sided=False):
     z_score = mean / sd
 
     # calculate p value
-    p_val = scipy.stats.norm.sf(abs(z_score))
+    p_val = _norm_sf(abs(z_score))
 
     # if distribution is two sided, multiply p value by 2
     if two_sided:
@@ -44,19 +76,25 @@ def get_power(p_A, p_B, se1, se2, two_sided=False, significance=0.05):
     Returns:
         float: A value between 0 and 1 representig the power of our experiment
     """
-    positive = p_B > p_A
-    null_hyp_z_score = scipy.stats.norm.isf(significance, loc=0, scale=1)
-    if positive or not two_sided:
-        power = scipy.stats.norm.sf(
-            (p_A + se1 * null_hyp_z_score - p_B) / se2,
-            loc=0,
-            scale=1,
-        )
-    else:
-        power = scipy.stats.norm.sf(
-            (p_B + se2 * null_hyp_z_score - p_A) / se1,
-            loc=0,
-            scale=1,
+    null_hyp_z_score = _norm_isf(significance)
+    if all(np.ndim(x) == 0 for x in (p_A, p_B, se1, se2)):
+        positive = p_B > p_A
+        if positive or not two_sided:
+            power = _norm_sf((p_A + se1 * null_hyp_z_score - p_B) / se2)
+        else:
+            power = _norm_sf((p_B + se2 * null_hyp_z_score - p_A) / se1)
+        return power
+
+    # element-wise, to support arrays of observations or effects
+    # np.where computes both branches, the unused one may divide by a zero standard error
+    positive = np.logical_or(p_B > p_A, not two_sided)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        power = _norm_sf(
+            np.where(
+                positive,
+                (p_A + se1 * null_hyp_z_score - p_B) / se2,
+                (p_B + se2 * null_hyp_z_score - p_A) / se1,
+            ),
         )
     return power
 
@@ -115,10 +153,7 @@ def get_p_val_and_power(
 
     power = get_power(p_A, p_B, se1, se2, two_sided, significance)
 
-    if power >= min_power and p_value <= statistical_significance:
-        result_is_significant = True
-    else:
-        result_is_significant = False
+    result_is_significant = (power >= min_power) & (p_value <= statistical_significance)
     return p_value, power, result_is_significant
 
 
@@ -151,18 +186,28 @@ def calculate_min_sample_size(
     Returns:
         int: Minimum sample size needed in each group to make the A/B test statistically significant.
     """
-    for nobs in range(step_size, max_feasible_observations, step_size):
-        res = get_p_val_and_power(
-            nobs_A=nobs,
+    # significance only improves with the sample size, so bisect the candidate sizes
+    # instead of testing them one by one: ~log2(n) scalar evaluations
+    candidates = range(step_size, max_feasible_observations, step_size)
+    low, high = 0, len(candidates)
+    while low < high:
+        middle = (low + high) // 2
+        _, _, is_significant = get_p_val_and_power(
+            nobs_A=candidates[middle],
             p_A=p_A,
             min_detect_effect=min_detect_effect,
             two_sided=two_sided,
             statistical_significance=statistical_significance,
             min_power=min_power,
         )
-        if res[2]:
-            return nobs
-    return None
+        if is_significant:
+            high = middle
+        else:
+            low = middle + 1
+
+    if low == len(candidates):
+        return None
+    return candidates[low]
 
 
 def calculate_min_detect_effect(
@@ -198,12 +243,15 @@ def calculate_min_detect_effect(
         float: the highest "minimum detectable effect" that would make this experiment statistically
             significant.
     """
-    for min_detect_effect in np.arange(
+    # evaluate all the candidate effects at once and pick the first significant one
+    min_detect_effect = np.arange(
         step_size,
         max_effect_tested + step_size,
         step_size,
-    ):
-        res = get_p_val_and_power(
+    )
+    # effects pushing p_B to 1 or above give invalid standard errors, never significant
+    with np.errstate(divide="ignore", invalid="ignore"):
+        _, _, is_significant = get_p_val_and_power(
             nobs_A=nobs_A,
             nobs_B=nobs_B,
             p_A=p_A,
@@ -212,9 +260,10 @@ def calculate_min_detect_effect(
             statistical_significance=statistical_significance,
             min_power=min_power,
         )
-        if res[2]:
-            return min_detect_effect
-    return None
+    first = np.argmax(is_significant)
+    if is_significant.size == 0 or not is_significant[first]:
+        return None
+    return min_detect_effect[first]
 
 
 if __name__ == "__main__":
@@ -1,19 +1,25 @@
-import random
-
 import numpy as np
 import pandas as pd
 
+# DuckDB column types (without precision) bucketed as numerical variables
+DUCKDB_NUMERIC_TYPES = {
+    "TINYINT", "SMALLINT", "INTEGER", "BIGINT", "HUGEINT",
+    "UTINYINT", "USMALLINT", "UINTEGER", "UBIGINT", "UHUGEINT",
+    "FLOAT", "DOUBLE", "DECIMAL",
+}
+
 
 def generate_dummy_data(n=50):
     # Sample data
-    age = np.random.randint(18, 65, n)  # age of the customers
+    rng = np.random.default_rng()
+    age = rng.integers(18, 65, n)  # age of the customers
     cities = ["Tbilisi", "Kutaisi", "Batumi"]
-    city = [random.choice(cities) for _ in range(n)]  # city of residence
+    city = pd.Categorical(rng.choice(cities, size=n))  # city of residence
 
-    sex = [random.choice(["M", "F"]) for _ in range(n)]
-    arpu = np.random.uniform(150, 600, n)  # Average Revenue Per User
-    data_consumption = np.random.uniform(1, 100, n)  # data consumption in GB
-    data_consumption_stratified = np.random.uniform(
+    sex = pd.Categorical(rng.choice(["M", "F"], size=n))
+    arpu = rng.uniform(150, 600, n)  # Average Revenue Per User
+    data_consumption = rng.uniform(1, 100, n)  # data consumption in GB
+    data_consumption_stratified = rng.uniform(
         1,
         100,
         n,
@@ -59,20 +65,35 @@ def proportional_stratified_sample(
     """
     # Check that the input df doesnt already have a "group" column
     assert "group" not in df.columns, "input df already has a 'group' column."
-    # For each column, we convert them to a categorical type
-    transformed_stratify_cols = []
+    # For each column, we convert them to integer bucket codes,
+    # and combine them into a single strata key per row
+    strata_key = np.zeros(len(df), dtype=np.int64)
     for col in stratify_cols:
-        if df[col].dtype.kind in "biufc":
-            df[col + "_stratify"] = pd.qcut(df[col], q=num_variables_default_buckets)
-            df[col + "_stratify"] = df[col + "_stratify"].astype(str)
+        values = df[col]
+        if values.dtype.kind in "iuf":
+            # quantile buckets, right inclusive as in pd.qcut, missing values in their own bucket
+            edges = np.nanquantile(
+                values.to_numpy(dtype=float),
+                np.linspace(0, 1, num_variables_default_buckets + 1),
+            )
+            codes = np.searchsorted(edges[1:-1], values.to_numpy(), side="left")
+            codes = np.where(values.isna(), num_variables_default_buckets, codes)
+            codes = codes.astype(np.int16)
+            n_codes = num_variables_default_buckets + 1
         else:
-            df[col + "_stratify"] = df[col].astype(str)
-        transformed_stratify_cols.append(col + "_stratify")
+            # missing values have code -1, shift them to 0
+            codes = values.astype("category").cat.codes.to_numpy() + 1
+            n_codes = codes.max(initial=0) + 1
+        strata_key = strata_key * n_codes + codes
 
     # Bucket size check
     # make sure each strata has at least N customers
     # Where N is the number of groups
-    bucket_counts = df[transformed_stratify_cols].value_counts()
+    _, strata, bucket_counts = np.unique(
+        strata_key,
+        return_inverse=True,
+        return_counts=True,
+    )
     assert bucket_counts.min() >= n_splits, (
         f"At least one strata has too few datapoints ({bucket_counts.min()})"
         f" to be split into {n_splits} groups."
@@ -82,25 +103,135 @@ def proportional_stratified_sample(
     )
 
     # split into stratified groups
+    # shuffle each strata once and deal its rows round-robin to the groups,
+    # starting from a random group so the remainders are spread evenly
     df = df.reset_index(drop=True)
-    df["group"] = None
+    rng = np.random.default_rng()
+    group_dtype = np.int8 if n_splits <= np.iinfo(np.int8).max else np.int32
+    groups = np.full(len(df), -1, dtype=group_dtype)
 
-    for i in range(n_splits):
-        df_ungroupped = df[df["group"].isna()]
-        group_i_indices = (
-            df_ungroupped.groupby(transformed_stratify_cols, group_keys=False)
-            .apply(lambda x: x.sample(frac=1 / (n_splits - i)))
-            .index
-        )
-        df.loc[group_i_indices, "group"] = i
-
-    assert not df["group"].isna().any(), "Some datapoints were not assigned a group"
+    strata_positions = np.split(
+        np.argsort(strata, kind="stable"),
+        np.cumsum(bucket_counts)[:-1],
+    )
+    for positions in strata_positions:
+        shuffled = rng.permutation(positions)
+        offset = rng.integers(n_splits)
+        np.put(groups, shuffled, (np.arange(len(shuffled)) + offset) % n_splits)
 
-    # drop _stratify columns
-    df = df.drop(columns=transformed_stratify_cols)
+    assert (groups != -1).all(), "Some datapoints were not assigned a group"
+    df["group"] = groups
     return df
 
 
+def proportional_stratified_sample_duckdb(
+    source,
+    stratify_cols,
+    n_splits=3,
+    num_variables_default_buckets=10,
+    output_path=None,
+):
+    """Split the sample in the input source in n different groups, stratified on
+        some given numeric or categorical variables, inside DuckDB.
+        Unlike proportional_stratified_sample, the data does not need to fit in memory,
+        as DuckDB streams parquet files and spills to disk when needed.
+
+
+    Args:
+        source (pd.DataFrame|str): input dataframe, or path/glob of parquet files,
+            with the sample you want to split into groups
+        stratify_cols (list): a list of columns you want to stratify the split on
+        n_splits (int, optional): number of output groups. Defaults to 3.
+        num_variables_default_buckets (int, optional): number of buckets to
+            split the numerical variables in. Defaults to 10.
+        output_path (str, optional): parquet file to write the result to, instead of
+            returning it as a dataframe. Defaults to None.
+
+
+    Returns:
+        pd.DataFrame: input sample with the "group" column, or None if output_path is given.
+            Unlike proportional_stratified_sample, rows are not returned in input order.
+    """
+    import duckdb
+
+    con = duckdb.connect()
+    if isinstance(source, pd.DataFrame):
+        con.register("source", source)
+    else:
+        con.read_parquet(source).create_view("source")
+
+    column_types = {name: kind for name, kind, *_ in con.execute("DESCRIBE source").fetchall()}
+    # Check that the input doesnt already have a "group" column
+    assert "group" not in column_types, "input source already has a 'group' column."
+
+    # For each column, we convert them to a bucket: quantile buckets for numerical variables,
+    # the value itself for categorical ones
+    quoted_cols = ['"' + col.replace('"', '""') + '"' for col in stratify_cols]
+    numeric = [column_types[col].split("(")[0] in DUCKDB_NUMERIC_TYPES for col in stratify_cols]
+
+    # quantile edges computed once, so every row with the same value falls in the same bucket
+    inner_quantiles = [q / num_variables_default_buckets for q in range(1, num_variables_default_buckets)]
+    edges = {}
+    if any(numeric):
+        quantiles = con.execute(
+            "SELECT "
+            + ", ".join(
+                f"quantile_cont({quoted}, {inner_quantiles})"
+                for quoted, is_numeric in zip(quoted_cols, numeric)
+                if is_numeric
+            )
+            + " FROM source"
+        ).fetchone()
+        edges = dict(zip([i for i, is_numeric in enumerate(numeric) if is_numeric], quantiles))
+
+    strata = []
+    for i, quoted in enumerate(quoted_cols):
+        if numeric[i]:
+            # right inclusive as in pd.qcut, missing values in their own bucket
+            cases = "".join(
+                f" WHEN {quoted} <= CAST('{edge!r}' AS DOUBLE) THEN {b}"
+                for b, edge in enumerate(edges[i] or [])
+            )
+            strata.append(
+                f"CASE WHEN {quoted} IS NULL THEN {num_variables_default_buckets}{cases}"
+                f" ELSE {len(edges[i] or [])} END AS _stratify_{i}"
+            )
+        else:
+            strata.append(f"{quoted} AS _stratify_{i}")
+    strata_cols = ", ".join(f"_stratify_{i}" for i in range(len(stratify_cols)))
+
+    con.execute(f"CREATE TEMP VIEW stratified AS SELECT *, {', '.join(strata)} FROM source")
+
+    # Bucket size check
+    # make sure each strata has at least N customers
+    # Where N is the number of groups
+    min_bucket_count = con.execute(
+        f"SELECT min(n) FROM (SELECT count(*) AS n FROM stratified GROUP BY {strata_cols})"
+    ).fetchone()[0]
+    assert min_bucket_count >= n_splits, (
+        f"At least one strata has too few datapoints ({min_bucket_count})"
+        f" to be split into {n_splits} groups."
+        f"\nTry reducing the number of stratify variables (currently {len(stratify_cols)}), "
+        "or reduce the number of buckets for each numerical variable"
+        f" (currently {num_variables_default_buckets})"
+    )
+
+    # split into stratified groups, dealing the shuffled rows of each strata round-robin,
+    # starting from a random group so the remainders are spread evenly
+    seed = int(np.random.default_rng().integers(2**31))
+    query = f"""
+        SELECT * EXCLUDE ({strata_cols}),
+            CAST((row_number() OVER (PARTITION BY {strata_cols} ORDER BY random()) - 1
+                + hash({strata_cols}, {seed}) % {n_splits})
+                % {n_splits} AS {'TINYINT' if n_splits <= 127 else 'INTEGER'}) AS "group"
+        FROM stratified
+    """
+    if output_path is not None:
+        con.sql(query).write_parquet(str(output_path))
+        return None
+    return con.execute(query).df()
+
+
 df = generate_dummy_data(n=50000)
 
 df_w_groups = proportional_stratified_sample(